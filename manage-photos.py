@@ -7,13 +7,19 @@
 import sys
 from functools import wraps
 from datetime import datetime
+from hashlib import md5
+from time import time
 import os
 
 import arrow
 from werkzeug import generate_password_hash
 
-from photos.models import db, User, Photo
-from photos.upload import UploadSession
+from playhouse.migrate import SqliteMigrator, migrate as run_migrations
+
+from photos.models import db, User, Photo, Counter, adjust_photo_count, phash_fields, similar_photos, hamming, create_search_index, index_comments, unindex_photo
+from photos.upload import UploadSession, get_metadata, ingest_file, hash_file, staging_dir, dhash
+from photos.application import app
+from photos import workers
 from photos import photo_storage
 
 def connected(f):
@@ -32,6 +38,134 @@ def create_tables(args):
     User.create_table()
     print('Creating Photo table')
     Photo.create_table()
+    print('Creating Counter table')
+    Counter.create_table()
+    print('Creating comment search index')
+    create_search_index()
+
+# Indexes added after the initial schema; the names match the ones peewee
+# generates in `create_table` so `migrate` is a no-op on new databases.
+INDEXES = [
+    ('photo_chksum', 'photo', ('chksum',), True),
+    ('photo_date_id', 'photo', ('date', 'id'), False),
+    ('photo_added_id', 'photo', ('added', 'id'), False),
+    ('photo_phash0', 'photo', ('phash0',), False),
+    ('photo_phash1', 'photo', ('phash1',), False),
+    ('photo_phash2', 'photo', ('phash2',), False),
+    ('photo_phash3', 'photo', ('phash3',), False),
+]
+
+# Columns added after the initial schema
+COLUMNS = [
+    ('photo', Photo.rotation),
+    ('photo', Photo.width),
+    ('photo', Photo.height),
+    ('photo', Photo.camera),
+    ('photo', Photo.phash),
+    ('photo', Photo.phash0),
+    ('photo', Photo.phash1),
+    ('photo', Photo.phash2),
+    ('photo', Photo.phash3),
+]
+
+@connected
+def migrate(args):
+    # older versions stored re-uploaded photos twice, which the unique
+    # index on chksum does not allow
+    dups = db.execute_sql('SELECT chksum, GROUP_CONCAT(id) FROM photo '
+                          'GROUP BY chksum HAVING COUNT(*) > 1').fetchall()
+    if dups:
+        print('Photos stored more than once (chksum: ids):')
+        for chksum, ids in dups:
+            print('  {0}: {1}'.format(chksum, ids))
+        sys.exit('''Remove all but one entry of each with
+  rmphoto ID
+and run migrate again.''')
+
+    print('Creating Counter table')
+    Counter.create_table(fail_silently=True)
+
+    migrator = SqliteMigrator(db)
+    for table, field in COLUMNS:
+        columns = [row[1] for row in db.execute_sql('PRAGMA table_info("{0}")'.format(table))]
+        if field.db_column not in columns:
+            print('Adding column {0}.{1}'.format(table, field.db_column))
+            run_migrations(migrator.add_column(table, field.db_column, field))
+
+    missing = Photo.select().where(Photo.width >> None)
+    print('Reading metadata of {0} photos'.format(missing.count()))
+    for p in missing:
+        try:
+            meta = get_metadata(photo_storage.path(p.chksum, False))
+        except IOError as e:
+            print('  {0}: {1}'.format(p.chksum, e))
+            continue
+        Photo.update(width=meta['width'], height=meta['height'],
+                     camera=meta['camera']).where(Photo.id == p.id).execute()
+
+    missing = Photo.select().where(Photo.phash >> None)
+    print('Hashing {0} thumbnails'.format(missing.count()))
+    for p in missing:
+        try:
+            h = dhash(photo_storage.path(p.chksum, True), p.rotation)
+        except IOError as e:
+            print('  {0}: {1}'.format(p.chksum, e))
+            continue
+        Photo.update(**phash_fields(h)).where(Photo.id == p.id).execute()
+
+    for name, table, columns, unique in INDEXES:
+        print('Creating index {0} on {1}({2})'.format(name, table, ', '.join(columns)))
+        sql = 'CREATE {0}INDEX IF NOT EXISTS "{1}" ON "{2}" ({3})'.format(
+                'UNIQUE ' if unique else '', name, table,
+                ', '.join('"{0}"'.format(c) for c in columns))
+        db.execute_sql(sql)
+    print('Building the comment search index')
+    create_search_index()
+    db.execute_sql('ANALYZE')
+
+@connected
+def dupes(args):
+    if len(args) == 0:
+        max_distance = app.config.get('DUPLICATE_DISTANCE', 3)
+    elif len(args) == 1:
+        max_distance = int(args[0])
+    else:
+        sys.exit('''dupes takes at most 1 argument:
+  dupes [MAX_DISTANCE]''')
+
+    tmpl = '{0:<6} {1:<6} {2:>4}  {3:%Y-%m-%d %H:%M}  {4:%Y-%m-%d %H:%M}'
+    print('{0:<6} {1:<6} {2:>4}  {3:<16}  {4:<16}'.format('Id', 'Id', 'Bits', 'Date', 'Date'))
+    n = 0
+    for p in Photo.select().where(~(Photo.phash >> None)).order_by(Photo.id):
+        for q in similar_photos(p.phash & (2**64 - 1), max_distance):
+            # each pair once
+            if q.id > p.id:
+                print(tmpl.format(p.id, q.id, hamming(p.phash, q.phash), p.date, q.date))
+                n += 1
+    print('{0} pairs of similar photos'.format(n))
+
+def migrate_storage(args):
+    """Move stored files from the flat to the sharded layout"""
+    if app.config.get('STORAGE_BACKEND', 'local') != 'local':
+        sys.exit('migrate-storage only works with the local storage backend')
+    top = app.config['PHOTO_STORAGE']
+    basedirs = [top] + [os.path.join(top, d) for d in sorted(os.listdir(top))
+                        if d.startswith('thumbs-') or d == 'rotated']
+    for basedir in basedirs:
+        if not os.path.isdir(basedir):
+            continue
+        print('Migrating', basedir)
+        n = 0
+        for name in sorted(os.listdir(basedir)):
+            # skip shard and other directories, temporary and lock files
+            if name.startswith('.') or name.endswith(('.tmp', '.lock')) \
+                    or not os.path.isfile(os.path.join(basedir, name)):
+                continue
+            photo_storage.migrate_file(basedir, name)
+            n += 1
+            if n % 1000 == 0:
+                print('  {0} files moved'.format(n))
+        print('  {0} files moved'.format(n))
 
 @connected
 def test_init(args):
@@ -67,7 +201,9 @@ def test_init(args):
                     added=datetime.utcnow(),
                     mimetype='image/jpeg')
             print(kw)
-            Photo.create(**kw)
+            p = Photo.create(**kw)
+            index_comments([p])
+            adjust_photo_count(1)
     else:
         print('Photo table already contains data')
 
@@ -157,6 +293,20 @@ def chpasswd(args):
     q = User.update(password=generate_password_hash(passwd)).where(User.name == name)
     q.execute()
     print('Updated password for user {0}'.format(name))
+    print('Running sessions of {0} end within USER_CHECK_INTERVAL'.format(name))
+
+@connected
+def chrole(args):
+    if len(args) == 2 and args[1] in ('uploader', 'viewer'):
+        name, role = args
+    else:
+        sys.exit('''chrole requires 2 arguments:
+  chrole NAME uploader|viewer''')
+
+    q = User.update(uploader=(role == 'uploader')).where(User.name == name)
+    q.execute()
+    print('User {0} is now {1}'.format(name, role))
+    print('Running sessions of {0} end within USER_CHECK_INTERVAL'.format(name))
     
 @connected
 def addphoto(args):
@@ -178,6 +328,108 @@ def addphoto(args):
 
     print('Added \'{0}\' with chksum={1} and comment \'{2}\''.format(path, chksum, comment))
 
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg')
+
+def find_images(top):
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(dirpath, name)
+
+def read_manifest(path):
+    """Status of the files handled by an earlier run of `import`"""
+    done = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                status, chksum, filepath = line.rstrip('\n').split('\t', 2)
+                done[filepath] = status
+    return done
+
+@connected
+def import_dir(args):
+    if len(args) == 1:
+        top, comment = args[0], ''
+    elif len(args) == 2:
+        top, comment = args
+    else:
+        sys.exit('''import requires 1 or 2 arguments:
+  import DIR [COMMENT]''')
+
+    top = os.path.abspath(top)
+    batch_size = int(app.config.get('IMPORT_BATCH_SIZE', 200))
+    manifest_path = os.path.join(staging_dir(),
+            'import-{0}.manifest'.format(md5(top.encode('utf-8')).hexdigest()))
+
+    done = read_manifest(manifest_path)
+    paths = [p for p in find_images(top) if done.get(p) not in ('imported', 'exists')]
+    print('Importing {0} files from {1} ({2} done before)'.format(len(paths), top, len(done)))
+    print('Manifest:', manifest_path)
+
+    us = UploadSession('import-{0:%s}'.format(datetime.utcnow()), 'create')
+    start = time()
+    counts = {'imported': 0, 'exists': 0, 'failed': 0}
+    try:
+        with open(manifest_path, 'a') as manifest:
+            for i in range(0, len(paths), batch_size):
+                batch = paths[i:i + batch_size]
+                status = {}
+
+                # hash first, so files already imported are not copied,
+                # decoded and thumbnailed again
+                hashes = {}
+                for p, job in [(p, workers.submit(hash_file, p)) for p in batch]:
+                    try:
+                        hashes[p] = job.result()
+                    except Exception as e:
+                        print('  {0}: {1}'.format(p, e))
+                        status[p] = ('failed', '-')
+
+                seen = set()
+                if hashes:
+                    q = Photo.select(Photo.chksum).where(Photo.chksum << list(set(hashes.values())))
+                    seen = set(ph.chksum for ph in q)
+                new = []
+                for p in batch:
+                    if p not in hashes:
+                        continue
+                    # also duplicates within the batch
+                    if hashes[p] in seen:
+                        status[p] = ('exists', hashes[p])
+                    else:
+                        seen.add(hashes[p])
+                        new.append(p)
+
+                jobs = [(p, workers.submit(ingest_file, us.outdir, us.thumbdir, p)) for p in new]
+                for p, job in jobs:
+                    try:
+                        r = job.result()
+                    except Exception as e:
+                        print('  {0}: {1}'.format(p, e))
+                        status[p] = ('failed', '-')
+                        continue
+                    r['comment'] = comment
+                    us.images[r['chksum']] = r
+                    status[p] = ('imported', r['chksum'])
+
+                us.dbimport(Photo)
+                us.images.clear()
+
+                for p in batch:
+                    st, chksum = status[p]
+                    counts[st] += 1
+                    manifest.write('{0}\t{1}\t{2}\n'.format(st, chksum, p))
+                manifest.flush()
+                os.fsync(manifest.fileno())
+
+                n = i + len(batch)
+                print('{0}/{1} files, {imported} imported, {exists} already present, '
+                      '{failed} failed, {2:.1f} files/s'.format(
+                          n, len(paths), n / (time() - start), **counts))
+    finally:
+        us.clear()
+
 @connected
 def rmphoto(args):
     if len(args) != 1:
@@ -193,13 +445,57 @@ def rmphoto(args):
     r = input('continue? [yes/NO] ')
     if r.lower() == 'yes':
         chksum = p.chksum
-        p.delete_instance()
+        with db.transaction():
+            p.delete_instance()
+            unindex_photo(p.id)
+            adjust_photo_count(-1)
         print('Deleted database entry')
+        if Photo.select().where(Photo.chksum == chksum).exists():
+            # a duplicate from before the unique index, which still needs them
+            print('Files kept, other entries refer to them')
+            return
         for thumb in (False, True):
-            p = photo_storage.path(chksum, thumb)
-            os.remove(p)
-            print('Deleted file', p)
-
+            photo_storage.remove(chksum, thumb)
+            print('Deleted file', photo_storage.key(chksum, thumb))
+        photo_storage.remove_renditions(chksum)
+        print('Deleted renditions')
+
+
+def _bench_thumbnails(paths, full):
+    import resource
+    from tempfile import TemporaryDirectory
+    from time import perf_counter
+    from PIL import Image
+    from photos.upload import make_thumbnail
+
+    times = []
+    with TemporaryDirectory() as tmpdir:
+        for p in paths:
+            start = perf_counter()
+            im = Image.open(p)
+            if full:
+                # loading first keeps `thumbnail` from decoding in draft mode
+                im.load()
+            make_thumbnail(im, os.path.join(tmpdir, 'thumb'))
+            times.append(perf_counter() - start)
+    return times, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def benchthumbs(args):
+    if not args:
+        sys.exit('''benchthumbs requires at least 1 argument:
+  benchthumbs IMAGE [IMAGE ...]''')
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    print('full: forced full resolution decode, draft: as done at ingest')
+    print('(this is not a comparison with older versions, which used draft mode too)')
+    print('{0:<8} {1:>10} {2:>10} {3:>12}'.format('mode', 'mean [ms]', 'max [ms]', 'peak RSS [KiB]'))
+    for name, full in (('full', True), ('draft', False)):
+        # a fresh process for each mode to get separate peak RSS values
+        with ProcessPoolExecutor(max_workers=1) as ex:
+            times, rss = ex.submit(_bench_thumbnails, args, full).result()
+        print('{0:<8} {1:>10.1f} {2:>10.1f} {3:>12}'.format(
+                name, 1000 * sum(times) / len(times), 1000 * max(times), rss))
 
 def main():
     arg2func = {
@@ -211,8 +507,14 @@ def main():
             'run' : run_app,
             'adduser' : adduser,
             'chpasswd' : chpasswd,
+            'chrole' : chrole,
             'addphoto' : addphoto,
-            'rmphoto': rmphoto
+            'import' : import_dir,
+            'rmphoto': rmphoto,
+            'migrate': migrate,
+            'migrate-storage': migrate_storage,
+            'dupes': dupes,
+            'benchthumbs': benchthumbs,
             }
     if len(sys.argv) >= 2 and sys.argv[1] in arg2func:
         arg2func[sys.argv[1]](sys.argv[2:])
@@ -6,8 +6,61 @@ DEBUG = True
 CSRF = True
 SECRET_KEY = 'this is not a secret'
 SERVER_NAME = 'photos.local:5050'
-# USE_X_SENDFILE = True # Enable this in production
+USER_CHECK_INTERVAL = 300 # seconds between checks of the session against the DB
+# How photos are sent: 'stream' (by the application), 'x-sendfile' (Apache
+# mod_xsendfile) or 'x-accel' (nginx, see X_ACCEL_LOCATIONS). Use one of the
+# latter in production.
+FILE_DELIVERY = 'stream'
+# X_ACCEL_LOCATIONS = {'/var/local/yorik-photos/data/photos/': '/_photos/'}
 
 DATABASE ='/home/eike/projects/yorik/test/db.sqlite'
+DB_MAX_CONNECTIONS = 8 # one per mod_wsgi thread
+DB_STALE_TIMEOUT = 3600 # seconds before an idle connection is reopened
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'wal'), # readers do not block on uploads
+    ('synchronous', 'normal'),
+    ('mmap_size', 256 * 2**20),
+    ('cache_size', -16000), # KiB
+    ('busy_timeout', 5000), # ms
+)
 PHOTO_STORAGE = '/home/eike/projects/yorik/test/pstore/'
+# Also look for files in the flat layout used before the sharded one; switch
+# off after `manage-photos.py migrate-storage`
+STORAGE_LEGACY_LAYOUT = True
+# Where photos are stored: 'local' (in PHOTO_STORAGE) or 's3' (an S3
+# compatible object store, needs boto3). With 's3', PHOTO_STORAGE only
+# holds upload sessions and a cache of local copies.
+STORAGE_BACKEND = 'local'
+# S3_BUCKET = 'yorik-photos'
+# S3_PREFIX = ''
+# S3_ENDPOINT_URL = 'http://localhost:9000' # e.g. MinIO
+# S3_ACCESS_KEY = ''
+# S3_SECRET_KEY = ''
+STORAGE_CACHE_DIR = None # None: PHOTO_STORAGE/cache
+STORAGE_CACHE_SIZE = 10 * 2**30 # bytes
 THUMB_WIDTH = '162' # pixels
+# Further sizes (name: pixels) created on first request
+RENDITIONS = {'screen': 800, 'large': 1600}
+# Formats offered besides JPEG to clients that accept them; formats Pillow
+# cannot write, e.g. WebP without libwebp, are skipped
+RENDITION_FORMATS = ('webp',)
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+# jpegtran executable for lossless rotation of originals (package
+# libjpeg-turbo-progs or libjpeg-progs), None: re-encode
+JPEGTRAN = None
+UPLOAD_BUFFER_SIZE = 2**20 # bytes read at once when copying uploads
+MAX_CONTENT_LENGTH = 16 * 2**20 # bytes per request, i.e. per upload chunk
+UPLOAD_CHUNK_SIZE = 4 * 2**20 # bytes per chunk sent by the upload page
+UPLOAD_MAX_FILE_SIZE = 2**30 # bytes
+UPLOAD_MAX_SESSION_SIZE = 8 * 2**30 # bytes staged per upload session
+UPLOAD_MAX_CONCURRENT = 4 # chunk requests per user at the same time
+IMAGE_WORKERS = None # image worker processes, None: one per CPU
+IMAGE_QUEUE_DEPTH = None # pending image jobs before submitting blocks, None: 4 per worker
+DUPLICATE_DISTANCE = 3 # max. differing bits of similar photos' hashes, < 4
+IMPORT_BATCH_SIZE = 200 # files per transaction of `manage-photos.py import`
+# Staging directory of uploads, None: PHOTO_STORAGE/staging. It should be on
+# the same file system as PHOTO_STORAGE, and must be accessible to the web
+# server when files are delivered with 'x-sendfile' or 'x-accel'.
+TMPDIR = None
+GALLERY_PAGE_SIZE = 50 # photos per gallery page, a multiple of 5
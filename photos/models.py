@@ -3,11 +3,31 @@
 ##
 
 from peewee import *
+from playhouse.pool import PooledDatabase
 from flask import g
 
 from .application import app
 
-db = SqliteDatabase(app.config['DATABASE'])
+class PragmaSqliteDatabase(SqliteDatabase):
+    """Applies the SQLITE_PRAGMAS to each new connection"""
+    def _connect(self, database, **kwargs):
+        conn = super()._connect(database, **kwargs)
+        for name, value in app.config.get('SQLITE_PRAGMAS', ()):
+            conn.execute('PRAGMA {0} = {1}'.format(name, value))
+        return conn
+
+class PhotoDatabase(PooledDatabase, PragmaSqliteDatabase):
+    """SQLite database with per-thread pooled connections
+
+    The pool only calls `PragmaSqliteDatabase._connect` for connections it
+    does not have yet, so the SQLITE_PRAGMAS are applied once per
+    connection, not on every request.
+    """
+
+db = PhotoDatabase(app.config['DATABASE'],
+                   threadlocals=True,
+                   max_connections=app.config.get('DB_MAX_CONNECTIONS', 8),
+                   stale_timeout=app.config.get('DB_STALE_TIMEOUT', 3600))
 
 # register DB connection with flask app
 @app.before_request
@@ -15,10 +35,12 @@ def establish_connection():
     g.db = db
     g.db.connect()
 
-@app.after_request
-def close_connection(response):
-    g.db.close()
-    return response
+@app.teardown_request
+def close_connection(exc):
+    # returns the connection to the pool; `g.db` is missing if the
+    # request was not preprocessed
+    if not db.is_closed():
+        db.close()
 
 
 class BaseModel(Model):
@@ -34,8 +56,107 @@ class User(BaseModel):
 
 class Photo(BaseModel):
     id = PrimaryKeyField()
-    chksum = CharField()
+    chksum = CharField(unique=True)
     mimetype = CharField()
     date = DateTimeField()
     added = DateTimeField()
     comment = TextField()
+    rotation = IntegerField(default=0) # clockwise, degrees
+    # of the stored image, i.e. before rotation
+    width = IntegerField(null=True)
+    height = IntegerField(null=True)
+    camera = CharField(null=True)
+    # difference hash of the thumbnail and its four 16 bit bands, which are
+    # indexed to find similar photos (see `similar_photos`)
+    phash = BigIntegerField(null=True)
+    phash0 = IntegerField(null=True, index=True)
+    phash1 = IntegerField(null=True, index=True)
+    phash2 = IntegerField(null=True, index=True)
+    phash3 = IntegerField(null=True, index=True)
+
+    class Meta:
+        # (sort key, id) pairs back the keyset queries of the views
+        indexes = (
+            (('date', 'id'), False),
+            (('added', 'id'), False),
+        )
+
+class Counter(BaseModel):
+    """Maintained row counts, to avoid `COUNT(*)` on every request"""
+    name = CharField(unique=True)
+    value = IntegerField(default=0)
+
+def photo_count():
+    try:
+        return Counter.get(Counter.name == 'photos').value
+    except Counter.DoesNotExist:
+        n = Photo.select().count()
+        Counter.create(name='photos', value=n)
+        return n
+
+def adjust_photo_count(delta):
+    # If the counter does not exist yet, nothing is updated and
+    # `photo_count` initializes it on its next call.
+    (Counter.update(value=Counter.value + delta)
+            .where(Counter.name == 'photos')
+            .execute())
+
+# Full text index of the comments
+#
+# An FTS5 table whose rowids are the photo ids. peewee has no model for
+# FTS5 tables, so it is kept up to date in SQL by whatever changes comments.
+
+def create_search_index():
+    """Create the comment index, if necessary, and fill it"""
+    with db.transaction():
+        db.execute_sql('CREATE VIRTUAL TABLE IF NOT EXISTS photo_fts '
+                       'USING fts5(comment, tokenize = "unicode61")')
+        db.execute_sql('DELETE FROM photo_fts')
+        db.execute_sql('INSERT INTO photo_fts (rowid, comment) '
+                       'SELECT id, comment FROM photo')
+
+def index_comments(photos):
+    """Add or update the comments of `photos` in the index"""
+    for p in photos:
+        unindex_photo(p.id)
+        db.execute_sql('INSERT INTO photo_fts (rowid, comment) VALUES (?, ?)',
+                       (p.id, p.comment))
+
+def unindex_photo(phid):
+    db.execute_sql('DELETE FROM photo_fts WHERE rowid = ?', (phid,))
+
+def comment_matches(query):
+    """Condition selecting the photos whose comment matches the FTS5
+    `query`"""
+    return Photo.id << SQL('(SELECT rowid FROM photo_fts WHERE photo_fts MATCH ?)', query)
+
+
+PHASH_BANDS = 4
+
+def phash_fields(h):
+    """Column values for the unsigned 64 bit hash `h`"""
+    fields = {'phash': h - 2**64 if h >= 2**63 else h}
+    for i in range(PHASH_BANDS):
+        fields['phash{0}'.format(i)] = (h >> (16 * i)) & 0xffff
+    return fields
+
+def hamming(a, b):
+    return bin((a ^ b) & (2**64 - 1)).count('1')
+
+def similar_photos(h, max_distance):
+    """Photos whose hash differs from `h` in at most `max_distance` bits
+
+    Hashes that close agree in at least one of the bands as long as
+    `max_distance` is less than their number, so only photos matching
+    a band through its index are compared.
+    """
+    if max_distance >= PHASH_BANDS:
+        raise ValueError('max_distance must be less than {0}'.format(PHASH_BANDS))
+    bands = phash_fields(h)
+    cond = None
+    for i in range(PHASH_BANDS):
+        name = 'phash{0}'.format(i)
+        c = getattr(Photo, name) == bands[name]
+        cond = c if cond is None else cond | c
+    return [p for p in Photo.select().where(cond)
+            if hamming(p.phash, h) <= max_distance]
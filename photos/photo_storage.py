@@ -2,37 +2,323 @@
 ## Copyright (c) 2014 Jan Eike von Seggern
 ##
 
-from os.path import join, exists
+import os
+import fcntl
+from os.path import join, dirname
 from hashlib import sha256
-from subprocess import check_call
+from zlib import crc32
+from subprocess import check_call, CalledProcessError
+from tempfile import mkstemp
+from io import BytesIO
+
+from flask import Response, request
+from werkzeug.wsgi import wrap_file
+from PIL import Image
 
 from .application import app
+from . import workers
+from .storage import storage
 
 class StorageError(Exception):
     pass
 
-def path(chksum, thumb):
+# Layout
+#
+# Files are stored in a fan-out of two directory levels named after the
+# first four characters of their name, e.g. ``ab/cd/abcdef...``, at the top
+# of the storage (originals) or below a directory per rendition. The keys
+# are the same for all storage backends (see `photos.storage`). The local
+# backend still finds files of the old flat layout, until
+# `manage-photos.py migrate-storage` has moved them and
+# STORAGE_LEGACY_LAYOUT is switched off.
+
+def sharded(basedir, name):
+    return join(basedir, name[0:2], name[2:4], name)
+
+def thumbdir():
+    return 'thumbs-{0}'.format(app.config['THUMB_WIDTH'])
+
+def key(chksum, thumb):
     if thumb:
-        parts = (app.config['PHOTO_STORAGE'], 'thumbs-{0}'.format(app.config['THUMB_WIDTH']), '{0}'.format(chksum))
+        return sharded(thumbdir(), '{0}'.format(chksum))
+    return sharded('', '{0}'.format(chksum))
+
+def path(chksum, thumb):
+    """Local path of a stored photo or its thumbnail"""
+    return storage().local_path(key(chksum, thumb))
+
+def store(chksum, thumb, src):
+    """Move the local file `src` into the storage"""
+    storage().store(key(chksum, thumb), src)
+
+def retrieve(chksum, thumb, dst):
+    """Move a stored photo or thumbnail out of the storage to `dst`"""
+    storage().retrieve(key(chksum, thumb), dst)
+
+def exists(chksum, thumb):
+    return storage().exists(key(chksum, thumb))
+
+def remove(chksum, thumb):
+    storage().remove(key(chksum, thumb))
+
+def migrate_file(basedir, name):
+    """Move `name` from the flat to the sharded layout of the local storage
+
+    Readers find the file in either place, so this is safe while the
+    application is running.
+    """
+    src = join(basedir, name)
+    dst = sharded(basedir, name)
+    os.makedirs(dirname(dst), exist_ok=True)
+    os.rename(src, dst)
+    return dst
+
+# Renditions
+#
+# Besides the original ('normal') and the thumbnail created at upload
+# ('small'), photos are available in the widths configured in RENDITIONS.
+# These are created on first request and stored next to the thumbnails.
+# All sizes but the original can also be rendered in the formats listed in
+# RENDITION_FORMATS, e.g. WebP; these are stored with the format as suffix.
+#
+# Originals are never modified. A rotation (clockwise, in degrees) is
+# applied when rendering and stored with an ``-r<degrees>`` suffix; rotated
+# originals are kept in ``rotated/``.
+
+FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp'),
+}
+
+ROTATIONS = (0, 90, 180, 270)
+
+# number of lock files for rendering (cf. `get_rendition`)
+LOCK_STRIPES = 256
+
+# `Image.transpose` methods rotating clockwise by the given angle
+TRANSPOSE = {
+    90: Image.ROTATE_270,
+    180: Image.ROTATE_180,
+    270: Image.ROTATE_90,
+}
+
+def sizes():
+    return ('normal', 'small') + tuple(app.config.get('RENDITIONS', {}))
+
+def formats():
+    """Rendition formats offered, leaving out those Pillow cannot write"""
+    # loads the format plugins, only the first call does any work
+    Image.init()
+    return ('jpeg',) + tuple(fmt for fmt in app.config.get('RENDITION_FORMATS', ())
+                             if FORMATS[fmt][0] in Image.SAVE)
+
+def mimetype(fmt):
+    return FORMATS[fmt][1]
+
+def save_options(fmt):
+    """Keyword arguments for `Image.save` in format `fmt`"""
+    if fmt == 'webp':
+        return {'quality': int(app.config.get('WEBP_QUALITY', 80))}
+    return {'quality': int(app.config.get('JPEG_QUALITY', 85)),
+            'optimize': True,
+            'progressive': True}
+
+def is_stored(size, fmt, rotation):
+    """Whether this variant is stored at upload rather than rendered"""
+    return rotation == 0 and (size == 'normal' or (size == 'small' and fmt == 'jpeg'))
+
+def rendition_key(chksum, size, fmt='jpeg', rotation=0):
+    if size == 'normal':
+        if rotation == 0:
+            return key(chksum, False)
+        basedir = 'rotated'
+    elif size == 'small':
+        if rotation == 0 and fmt == 'jpeg':
+            return key(chksum, True)
+        basedir = thumbdir()
     else:
-        parts = (app.config['PHOTO_STORAGE'], '{0}'.format(chksum))
-    return join(*parts)
+        basedir = 'thumbs-{0}'.format(app.config['RENDITIONS'][size])
+
+    name = chksum
+    if rotation != 0:
+        name = '{0}-r{1}'.format(name, rotation)
+    if fmt != 'jpeg':
+        name = '{0}.{1}'.format(name, fmt)
+    return sharded(basedir, name)
+
+def render(src, dst, width, fmt, options, rotation):
+    """Write `src` scaled to fit `width` x `width` and rotated clockwise by
+    `rotation` to `dst`"""
+    im = Image.open(src)
+    # decodes JPEGs in draft mode
+    im.thumbnail((width, width), Image.ANTIALIAS)
+    if rotation != 0:
+        im = im.transpose(TRANSPOSE[rotation])
+    im.save(dst, FORMATS[fmt][0], **options)
+
+def rotate_original(src, dst, rotation):
+    """Write `src` rotated clockwise by `rotation` to `dst`
+
+    With JPEGTRAN configured the JPEG data is transformed losslessly. If
+    that is impossible, because the image size is not a multiple of the
+    block size, or jpegtran is missing, it is decoded and encoded again.
+    EXIF data is dropped in both cases.
+    """
+    jpegtran = app.config.get('JPEGTRAN')
+    if jpegtran:
+        # without EXIF data, browsers would apply its orientation on top
+        try:
+            check_call([jpegtran, '-copy', 'comments', '-perfect',
+                        '-rotate', str(rotation), '-outfile', dst, src])
+            return
+        except (OSError, CalledProcessError) as e:
+            print('jpegtran failed, re-encoding {0}: {1}'.format(src, e))
+
+    im = Image.open(src)
+    im.transpose(TRANSPOSE[rotation]).save(dst, 'JPEG', quality=95)
+
+def get_rendition(chksum, size, fmt='jpeg', rotation=0):
+    """Local path of `size` of the photo in format `fmt` and rotated by
+    `rotation`, creating the rendition if needed
+
+    Concurrent requests for a missing rendition wait for the first one to
+    create it, instead of all rendering it.
+    """
+    st = storage()
+    k = rendition_key(chksum, size, fmt, rotation)
+    if is_stored(size, fmt, rotation) or st.exists(k):
+        return st.local_path(k)
+
+    lockdir = join(app.config['PHOTO_STORAGE'], 'locks')
+    os.makedirs(lockdir, exist_ok=True)
+    # A fixed set of lock files, each shared by many renditions. They are
+    # never removed: removing one while others wait on it would let a
+    # newcomer lock a new file while they still hold the old one.
+    lockpath = join(lockdir, '{0:02x}'.format(crc32(k.encode('utf-8')) % LOCK_STRIPES))
+    with open(lockpath, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not st.exists(k):
+                src = st.local_path(key(chksum, False))
+                fd, tmp = mkstemp(dir=lockdir, prefix='.render-')
+                os.close(fd)
+                try:
+                    if size == 'normal':
+                        workers.run(rotate_original, src, tmp, rotation)
+                    else:
+                        if size == 'small':
+                            width = int(app.config['THUMB_WIDTH'])
+                        else:
+                            width = int(app.config['RENDITIONS'][size])
+                        workers.run(render, src, tmp, width, fmt,
+                                    save_options(fmt), rotation)
+                    st.store(k, tmp)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return st.local_path(k)
+
+def remove_renditions(chksum):
+    """Remove the renditions created on demand"""
+    st = storage()
+    for size in sizes():
+        for fmt in formats():
+            for rotation in ROTATIONS:
+                if not is_stored(size, fmt, rotation):
+                    st.remove(rendition_key(chksum, size, fmt, rotation))
+
+def display_size(width, height, size, rotation):
+    """Size in pixels at which the `size` rendition of a stored image of
+    `width` x `height` pixels is displayed"""
+    if size != 'normal':
+        if size == 'small':
+            limit = int(app.config['THUMB_WIDTH'])
+        else:
+            limit = int(app.config['RENDITIONS'][size])
+        # as `Image.thumbnail`
+        if width > limit:
+            height = max(int(height * limit / width), 1)
+            width = limit
+        if height > limit:
+            width = max(int(width * limit / height), 1)
+            height = limit
+    if rotation in (90, 270):
+        width, height = height, width
+    return width, height
 
 def get_photo(chksum):
-    return open(path(chksum, False))
+    return storage().open(key(chksum, False))
 
 def get_thumbnail(chksum):
-    return open(path(chksum, True))
+    return storage().open(key(chksum, True))
 
 def store_photo(data):
     chksum = sha256(data).hexdigest()
 
-    p = path(chksum, False)
-    t = path(chksum, False)
-    if exists(p) or exists(t):
+    if exists(chksum, False) or exists(chksum, True):
         raise StorageError('Photo with chksum {0} already uploaded!'.format(chksum))
 
-    with open(p, 'w') as of:
-        of.write(data)
+    storage().write(key(chksum, False), BytesIO(data))
 
+    p = path(chksum, False)
+    fd, t = mkstemp(dir=app.config['PHOTO_STORAGE'], prefix='.thumb-')
+    os.close(fd)
     check_call(['convert', '-resize', app.config['THUMB_WIDTH'], p, t])
+    store(chksum, True, t)
+
+
+# File delivery backends
+#
+# Each backend turns a local file into a response. Backends other than
+# 'stream' only set a header and let the web server send the file, so no
+# application thread is busy while the bytes go out. Select one with the
+# FILE_DELIVERY setting.
+
+def stream_file(path, mimetype):
+    """Send the file from within the application"""
+    rv = Response(wrap_file(request.environ, open(path, 'rb')),
+                  mimetype=mimetype, direct_passthrough=True)
+    rv.content_length = os.path.getsize(path)
+    return rv
+
+def x_sendfile(path, mimetype):
+    """Let Apache's mod_xsendfile send the file (see XSendFilePath)"""
+    rv = Response(mimetype=mimetype)
+    rv.headers['X-Sendfile'] = path
+    return rv
+
+def x_accel_redirect(path, mimetype):
+    """Let nginx send the file from an internal location
+
+    X_ACCEL_LOCATIONS maps local directories to internal nginx locations,
+    e.g. ``{'/var/local/yorik-photos/data/photos/': '/_photos/'}``. Files
+    outside these directories are streamed.
+    """
+    path = os.path.abspath(path)
+    for root, location in app.config.get('X_ACCEL_LOCATIONS', {}).items():
+        root = os.path.join(os.path.abspath(root), '')
+        if path.startswith(root):
+            rv = Response(mimetype=mimetype)
+            rv.headers['X-Accel-Redirect'] = location.rstrip('/') + '/' + path[len(root):]
+            return rv
+    return stream_file(path, mimetype)
+
+DELIVERY_BACKENDS = {
+    'stream': stream_file,
+    'x-sendfile': x_sendfile,
+    'x-accel': x_accel_redirect,
+}
+
+def send(path, mimetype):
+    """Response for the file at `path` using the configured backend
+
+    The `content_length` of the response is only set if the application
+    sends the body itself.
+    """
+    try:
+        backend = DELIVERY_BACKENDS[app.config.get('FILE_DELIVERY', 'stream')]
+    except KeyError:
+        raise StorageError('Unknown FILE_DELIVERY {0!r}'.format(app.config.get('FILE_DELIVERY')))
+    return backend(path, mimetype)
@@ -0,0 +1,274 @@
+##
+## Copyright (c) 2014 Jan Eike von Seggern
+##
+
+import os
+from os.path import join, exists, dirname, basename, getsize
+from shutil import copyfileobj, move
+from threading import Lock, get_ident
+import errno
+
+from .application import app
+
+# Storage backends
+#
+# A backend stores files under keys, which are relative paths like
+# ``ab/cd/<chksum>`` or ``thumbs-162/ab/cd/<chksum>`` (cf. `photo_storage`).
+# Besides reading and writing streams, every backend provides a local file
+# for each key, as image processing and the file delivery need one.
+# Select the backend with STORAGE_BACKEND.
+
+class LocalStorage:
+    """Files below a local directory, by default PHOTO_STORAGE"""
+
+    def __init__(self, root, legacy_layout=False):
+        self.root = root
+        self.legacy_layout = legacy_layout
+
+    def local_path(self, key):
+        """Path of the file stored under `key`
+
+        With `legacy_layout`, files of the flat layout, which lacks the two
+        shard directories, are found as well.
+        """
+        p = join(self.root, key)
+        if self.legacy_layout and not exists(p):
+            shards = dirname(dirname(dirname(key)))
+            legacy = join(self.root, shards, basename(key))
+            if exists(legacy):
+                return legacy
+        return p
+
+    def exists(self, key):
+        return exists(self.local_path(key))
+
+    def open(self, key):
+        return open(self.local_path(key), 'rb')
+
+    def write(self, key, fin):
+        p = join(self.root, key)
+        os.makedirs(dirname(p), exist_ok=True)
+        tmp = '{0}.tmp-{1}-{2}'.format(p, os.getpid(), get_ident())
+        with open(tmp, 'wb') as fout:
+            copyfileobj(fin, fout, 2**20)
+        os.rename(tmp, p)
+
+    def store(self, key, src):
+        """Move the local file `src` into the storage"""
+        p = join(self.root, key)
+        os.makedirs(dirname(p), exist_ok=True)
+        rename(src, p)
+
+    def retrieve(self, key, dst):
+        """Move the file stored under `key` out of the storage to `dst`"""
+        rename(self.local_path(key), dst)
+
+    def remove(self, key):
+        p = self.local_path(key)
+        if exists(p):
+            os.remove(p)
+
+
+class S3Storage:
+    """Objects in an S3 compatible object store
+
+    Local copies are kept in a `DiskCache`. Needs boto3, unless a `client`
+    with the same interface is passed.
+    """
+
+    def __init__(self, bucket, prefix='', cache=None, client=None, **client_args):
+        if client is None:
+            import boto3
+            client = boto3.client('s3', **client_args)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache = cache
+
+    def _name(self, key):
+        return self.prefix + key
+
+    def _not_found(self, e):
+        code = e.response.get('Error', {}).get('Code')
+        return code in ('404', 'NoSuchKey', 'NotFound')
+
+    def local_path(self, key):
+        return self.cache.get(key, lambda dst: self.download(key, dst))
+
+    def download(self, key, dst):
+        with open(dst, 'wb') as fout:
+            self.client.download_fileobj(self.bucket, self._name(key), fout)
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        if self.cache.contains(key):
+            return True
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._name(key))
+        except ClientError as e:
+            if self._not_found(e):
+                return False
+            raise
+        return True
+
+    def open(self, key):
+        """Stream of the object; it is not read completely into memory"""
+        return self.client.get_object(Bucket=self.bucket, Key=self._name(key))['Body']
+
+    def write(self, key, fin):
+        # multipart upload for large files
+        self.client.upload_fileobj(fin, self.bucket, self._name(key))
+
+    def store(self, key, src):
+        with open(src, 'rb') as fin:
+            self.write(key, fin)
+        # keep the file as local copy
+        self.cache.put(key, src)
+
+    def retrieve(self, key, dst):
+        # downloads the object unless it is cached
+        self.local_path(key)
+        self.cache.take(key, dst)
+        self.remove(key)
+
+    def remove(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._name(key))
+        self.cache.discard(key)
+
+
+class DiskCache:
+    """Local copies of stored files, at most `max_bytes` in total
+
+    When the limit is exceeded, the least recently used files are removed
+    until 90% of it is left. Files are marked as used by updating their
+    modification time.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._size = None
+
+    def path(self, key):
+        return join(self.directory, key)
+
+    def contains(self, key):
+        return exists(self.path(key))
+
+    def get(self, key, fill):
+        """Local path of `key`, calling `fill(path)` to create it if it is
+        not cached"""
+        p = self.path(key)
+        try:
+            os.utime(p)
+            return p
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        os.makedirs(dirname(p), exist_ok=True)
+        tmp = '{0}.tmp-{1}-{2}'.format(p, os.getpid(), get_ident())
+        try:
+            fill(tmp)
+            os.rename(tmp, p)
+        except:
+            if exists(tmp):
+                os.remove(tmp)
+            raise
+        self._added(getsize(p))
+        return p
+
+    def put(self, key, src):
+        """Move the local file `src` into the cache"""
+        p = self.path(key)
+        os.makedirs(dirname(p), exist_ok=True)
+        rename(src, p)
+        self._added(getsize(p))
+
+    def take(self, key, dst):
+        """Move the cached file of `key` out of the cache to `dst`"""
+        p = self.path(key)
+        size = getsize(p)
+        rename(p, dst)
+        self._removed(size)
+
+    def discard(self, key):
+        p = self.path(key)
+        try:
+            size = getsize(p)
+            os.remove(p)
+        except FileNotFoundError:
+            return
+        self._removed(size)
+
+    def _removed(self, size):
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+
+    def _files(self):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                p = join(dirpath, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, p
+
+    def _added(self, size):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(s for t, s, p in self._files())
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        files = sorted(self._files())
+        total = sum(s for t, s, p in files)
+        for mtime, size, p in files:
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(p)
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+
+def rename(src, dst):
+    """Rename `src` to `dst`, copying only if they are on different file
+    systems"""
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        move(src, dst)
+
+_storage = None
+
+def storage():
+    """The configured storage backend"""
+    global _storage
+    if _storage is None:
+        backend = app.config.get('STORAGE_BACKEND', 'local')
+        if backend == 'local':
+            _storage = LocalStorage(app.config['PHOTO_STORAGE'],
+                                    app.config.get('STORAGE_LEGACY_LAYOUT', True))
+        elif backend == 's3':
+            cache = DiskCache(app.config.get('STORAGE_CACHE_DIR') or join(app.config['PHOTO_STORAGE'], 'cache'),
+                              int(app.config.get('STORAGE_CACHE_SIZE', 10 * 2**30)))
+            _storage = S3Storage(app.config['S3_BUCKET'],
+                                 app.config.get('S3_PREFIX', ''),
+                                 cache,
+                                 endpoint_url=app.config.get('S3_ENDPOINT_URL'),
+                                 aws_access_key_id=app.config.get('S3_ACCESS_KEY'),
+                                 aws_secret_access_key=app.config.get('S3_SECRET_KEY'))
+        else:
+            raise ValueError('Unknown STORAGE_BACKEND {0!r}'.format(backend))
+    return _storage
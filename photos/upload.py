@@ -3,103 +3,366 @@
 ##
 
 import os
+import json
+import fcntl
 from os import path
-from shutil import copyfileobj, move, rmtree
-from multiprocessing.dummy import Pool
+from shutil import rmtree
 from io import IOBase
+from mmap import mmap, ACCESS_READ
+from tempfile import mkstemp
 from hashlib import md5
 from datetime import datetime
+from time import time
+from threading import Lock, Condition
+from functools import partial
+from contextlib import contextmanager
 
 from PIL import Image
 
 from . import photo_storage
+from . import workers
+from .models import adjust_photo_count, phash_fields, index_comments
 from .application import app
 thumb_width = int(app.config['THUMB_WIDTH'])
 
-def md5hex(fd, block_size=2**10):
-    dig = md5()
+buffer_size = int(app.config.get('UPLOAD_BUFFER_SIZE', 2**20))
+
+def md5hex_update(dig, fd, block_size=buffer_size):
     buf = fd.read(block_size)
     while buf:
         dig.update(buf)
         buf = fd.read(block_size)
 
+def md5hex(fd, block_size=buffer_size):
+    dig = md5()
+    md5hex_update(dig, fd, block_size)
+    return dig.hexdigest()
+
+def copy_md5hex(fin, fout, block_size=buffer_size):
+    """Copy `fin` to `fout` and return the md5 hexdigest of the data"""
+    dig = md5()
+    buf = fin.read(block_size)
+    while buf:
+        dig.update(buf)
+        fout.write(buf)
+        buf = fin.read(block_size)
+
     return dig.hexdigest()
 
 
-def prepare_photo(outdir, thumbdir, fin, filename):
+def store_upload(outdir, thumbdir, fin, filename):
+    """Copy `fin` to `outdir` and return its checksum"""
     print('loading', filename, 'to', outdir, 'from', fin)
     fin.seek(0)
-    chksum = md5hex(fin)
 
-    impath = path.join(outdir, chksum)
-    if path.exists(impath):
-        raise IOError("Output file '{0}' already exists".format(impath))
+    # Copy image to `outdir` and hash it in the same pass. The name is only
+    # known afterwards, so write to a temporary file first.
+    fd, tmppath = mkstemp(dir=outdir, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            chksum = copy_md5hex(fin, fout)
 
-    thumbpath = path.join(thumbdir, chksum)
-    if path.exists(thumbpath):
-        raise IOError("Thumbnail file '{0}' already exists".format(impath))
+        impath = path.join(outdir, chksum)
+        if path.exists(impath):
+            raise IOError("Output file '{0}' already exists".format(impath))
 
-    print(filename, 'files ok')
+        thumbpath = path.join(thumbdir, chksum)
+        if path.exists(thumbpath):
+            raise IOError("Thumbnail file '{0}' already exists".format(impath))
 
-    # Copy image to `outdir`
-    fin.seek(0)
-    with open(impath, 'wb') as fout:
-        copyfileobj(fin, fout)
+        os.rename(tmppath, impath)
+    except:
+        os.remove(tmppath)
+        raise
     print(filename, 'copied')
+    return chksum
+
+def make_thumbnail(im, thumbpath):
+    """Save a thumbnail of `im` to `thumbpath`
+
+    `Image.thumbnail` decodes JPEGs at the smallest DCT scale (1/2, 1/4 or
+    1/8) that is still larger than the thumbnail, as long as `im` is not
+    loaded yet.
+    """
+    im.thumbnail((thumb_width, thumb_width), Image.ANTIALIAS)
+    im.save(thumbpath, 'JPEG', **photo_storage.save_options('jpeg'))
+
+def dhash(im, rotation=0, size=8):
+    """Difference hash of `im`: one bit per pair of horizontally adjacent
+    pixels of a `size` x `size` gray version, set if the left one is
+    brighter. Resized or re-encoded copies get (nearly) the same hash.
+
+    `im` is rotated clockwise by `rotation` first, so a copy with its EXIF
+    orientation applied to the pixels hashes the same.
+    """
+    if isinstance(im, (str, IOBase)):
+        im = Image.open(im)
+    if rotation:
+        im = im.transpose(photo_storage.TRANSPOSE[rotation])
+
+    px = list(im.convert('L').resize((size + 1, size), Image.ANTIALIAS).getdata())
+    h = 0
+    for row in range(size):
+        for col in range(size):
+            i = row * (size + 1) + col
+            h = (h << 1) | (px[i] > px[i + 1])
+    return h
+
+def prepare_photo(outdir, thumbdir, chksum, filename):
+    """Read the metadata of a stored upload and create its thumbnail
+
+    This runs in the image worker processes (see `photos.workers`).
+    """
+    impath = path.join(outdir, chksum)
+    thumbpath = path.join(thumbdir, chksum)
 
-    # Get date
-    fin.seek(0)
-    im = Image.open(fin)
-    dt = get_exifdate(im)
-    print(filename, 'datetime:', dt)
-
-    # Create thumbnail
-    print(filename, 'creating thumbnail...')
-    try:
-        im.thumbnail((thumb_width, thumb_width), Image.ANTIALIAS)
-        im.save(thumbpath, 'JPEG')
-    except Exception as e:
-        print('XXX', e)
-        raise e
-    print(filename, 'thumbnail saved')
-
-    r = {'chksum': chksum, 'date': dt, 'filename': filename}
+    with open(impath, 'rb') as f, mmap(f.fileno(), 0, access=ACCESS_READ) as mm:
+        # Get date, size and orientation
+        im = Image.open(mm)
+        meta = get_metadata(im)
+        print(filename, 'metadata:', meta)
+
+        # Create thumbnail
+        print(filename, 'creating thumbnail...')
+        try:
+            make_thumbnail(im, thumbpath)
+        except Exception as e:
+            print('XXX', e)
+            raise e
+        print(filename, 'thumbnail saved')
+        # `im` is the thumbnail now
+        phash = dhash(im, meta['rotation'])
+
+    r = {'chksum': chksum, 'filename': filename, 'phash': phash}
+    r.update(meta)
     print(filename, '->', r)
     return r
 
-def rotate_photo(chksum, direction):
+def staging_dir():
+    """Directory for upload sessions
+
+    By default it is inside PHOTO_STORAGE, so importing a session into the
+    local storage only renames files.
+    """
+    return app.config.get('TMPDIR') or path.join(app.config['PHOTO_STORAGE'], 'staging')
+
+def hash_file(filepath):
+    """Checksum of the local file `filepath`, as `store_upload` computes it"""
+    with open(filepath, 'rb') as f:
+        return md5hex(f)
+
+def ingest_file(outdir, thumbdir, filepath):
+    """Stage the local file `filepath` like an upload
+
+    Unlike `store_upload` this runs completely in an image worker process.
+    """
+    with open(filepath, 'rb') as fin:
+        chksum = store_upload(outdir, thumbdir, fin, filepath)
+    return prepare_photo(outdir, thumbdir, chksum, filepath)
+
+def rotate_photo(photo, direction):
+    """Rotate `photo` by 90 degrees to the left or right
+
+    Only the rotation is stored; it is applied when rendering, so the
+    original file stays unchanged.
+    """
     if direction == "right":
-        angle = -90
-    else:
         angle = 90
+    else:
+        # SQLite keeps the sign of the dividend in %
+        angle = 270
+
+    # in one statement, so overlapping clicks both count
+    model = type(photo)
+    (model.update(rotation=(model.rotation + angle) % 360)
+          .where(model.id == photo.id)
+          .execute())
+    photo.rotation = model.get(model.id == photo.id).rotation
+
+
+# EXIF tags, copied from PIL.ExifTags
+DATETIMEKEY = 0x0132
+DATETIMEORIGINALKEY = 0x9003
+ORIENTATIONKEY = 0x0112
+MAKEKEY = 0x010F
+MODELKEY = 0x0110
 
-    for thumb in (True, False):
-        p = photo_storage.path(chksum, thumb)
-        im = Image.open(p)
-        im = im.rotate(angle)
-        im.save(p, 'JPEG')
+# clockwise rotation for the EXIF orientations; mirrored images are only
+# rotated
+ORIENTATION2ROTATION = {1: 0, 2: 0, 3: 180, 4: 180, 5: 90, 6: 90, 7: 270, 8: 270}
 
+def get_exif(im):
+    try:
+        exif = im._getexif()
+    except (AttributeError, IndexError, SyntaxError, ValueError):
+        # no or broken EXIF data
+        exif = None
+    return exif or {}
+
+def parse_exifdate(value):
+    try:
+        return datetime.strptime(value.strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+    except (AttributeError, ValueError):
+        return None
 
-DATETIMEKEY = 0x0132 # copied from PIL.ExifTags
 def get_exifdate(im):
     if isinstance(im, (str, IOBase)):
         im = Image.open(im)
 
-    exif = im._getexif()
-    if DATETIMEKEY in exif:
-        dt = datetime.strptime(exif[DATETIMEKEY], '%Y:%m:%d %H:%M:%S')
-    else:
-        dt = datetime.utcnow()
+    exif = get_exif(im)
+    for key in (DATETIMEORIGINALKEY, DATETIMEKEY):
+        dt = parse_exifdate(exif.get(key))
+        if dt is not None:
+            return dt
+
+    return datetime.utcnow()
+
+def get_metadata(im):
+    """Everything the views need to know about a photo, read once at ingest
+
+    Returns a dict with the recording date, the size of the stored image,
+    the rotation needed to display it upright and the camera.
+    """
+    if isinstance(im, (str, IOBase)):
+        im = Image.open(im)
 
-    return dt
+    exif = get_exif(im)
+    camera = ' '.join(str(exif[key]).strip('\x00 ') for key in (MAKEKEY, MODELKEY) if key in exif)
+    width, height = im.size
+    return {'date': get_exifdate(im),
+            'width': width,
+            'height': height,
+            'rotation': ORIENTATION2ROTATION.get(exif.get(ORIENTATIONKEY), 0),
+            'camera': camera or None}
+
+class UploadError(Exception):
+    pass
+
+class OffsetMismatch(UploadError):
+    """A chunk does not continue the partial file at `offset`"""
+    def __init__(self, offset):
+        UploadError.__init__(self, 'expected offset {0}'.format(offset))
+        self.offset = offset
+
+class UploadBusy(UploadError):
+    """Another request is still writing to the same file"""
+
+# md5 state of partial uploads by (session id, file id), with the offset it
+# covers; after a restart it is rebuilt from the partial file
+_partial_hashes = {}
+_partial_lock = Lock()
+
+class IngestJob:
+    """Progress of the image processing of one upload session
+
+    The files are processed by the image workers in the background; the
+    status of each file is updated as its result arrives.
+    """
+    def __init__(self, sessionid):
+        self.sessionid = sessionid
+        self.created = time()
+        self.files = []
+        self.lock = Condition()
+        # similar photos in the archive by checksum, filled by the views
+        self.similar = {}
+
+    def add(self, filename, chksum=None, future=None, error=None):
+        entry = {'filename': filename, 'chksum': chksum}
+        if future is None:
+            entry['status'] = 'failed'
+            entry['error'] = error
+        else:
+            entry['status'] = 'processing'
+            # the callbacks of `UploadSession` were added before this one and
+            # have run when the status changes
+            future.add_done_callback(partial(self.__done, entry))
+        with self.lock:
+            self.files.append(entry)
+
+    def __done(self, entry, future):
+        with self.lock:
+            try:
+                result = future.result()
+            except Exception as e:
+                entry['status'] = 'failed'
+                entry['error'] = str(e)
+            else:
+                entry['status'] = 'done'
+                entry['date'] = result['date']
+                entry['phash'] = result.get('phash')
+            self.lock.notify_all()
+
+    def status(self):
+        with self.lock:
+            files = [dict(f) for f in self.files]
+        return {'session': self.sessionid,
+                'finished': all(f['status'] != 'processing' for f in files),
+                'files': files}
+
+    def wait(self):
+        with self.lock:
+            self.lock.wait_for(lambda: all(f['status'] != 'processing' for f in self.files))
+
+_jobs = {}
+_jobs_lock = Lock()
+
+def start_job(sessionid):
+    """Register a new `IngestJob`, forgetting jobs older than a day and
+    the staged files of abandoned sessions"""
+    job = IngestJob(sessionid)
+    with _jobs_lock:
+        for sid, old in list(_jobs.items()):
+            if old.created < time() - 86400:
+                del _jobs[sid]
+        _jobs[sessionid] = job
+        active = set(_jobs)
+    prune_staging(86400, active)
+    return job
+
+def prune_staging(max_age, keep=()):
+    """Remove session directories from the staging directory that have not
+    changed for `max_age` seconds, except the sessions in `keep`
+
+    Partial uploads of abandoned sessions would stay there forever
+    otherwise.
+    """
+    top = staging_dir()
+    try:
+        names = os.listdir(top)
+    except FileNotFoundError:
+        return
+    for name in names:
+        d = path.join(top, name)
+        if name in keep or not path.isdir(d):
+            continue
+        try:
+            # appending to a file does not touch the directory
+            changed = max([path.getmtime(d)] +
+                          [path.getmtime(path.join(d, f)) for f in os.listdir(d)])
+        except OSError:
+            continue
+        if changed < time() - max_age:
+            print('removing abandoned upload session', d)
+            rmtree(d, ignore_errors=True)
+
+def get_job(sessionid):
+    with _jobs_lock:
+        return _jobs.get(sessionid)
+
+def end_job(sessionid):
+    with _jobs_lock:
+        return _jobs.pop(sessionid, None)
+
+
+MANIFEST_DATEFMT = '%Y-%m-%dT%H:%M:%S.%f'
 
 class UploadSession:
     def __init__(self, sessionid, load=None):
         self.sessionid = sessionid
-        self.outdir = path.join(app.config.get('TMPDIR', '/tmp'), sessionid)
+        self.outdir = path.join(staging_dir(), sessionid)
         self.thumbdir = path.join(self.outdir, '{0}'.format(thumb_width))
 
-        self.pool = Pool()
+        self.jobs = []
         self.images = {}
 
         if load == 'load':
@@ -110,6 +373,7 @@ class UploadSession:
             raise ValueError('load must be "load", "create" or None')
 
     def __create(self):
+        os.makedirs(staging_dir(), 0o0700, exist_ok=True)
         if path.exists(self.outdir):
             raise IOError('Output directory \'{0}\' exists'.format(self.outdir))
         os.mkdir(self.outdir, 0o0700)
@@ -120,24 +384,182 @@ class UploadSession:
             raise IOError('Output directory \'{0}\' or \'{1}\' does not exist'.format(self.outdir, self.thumbdir))
 
         print('loading upload session {0} from {1} ...'.format(self.sessionid, self.outdir))
+        self.images = self.read_manifest()
+
+    # The manifest holds the results of the image processing, so loading a
+    # session does not need to open the images again. It is rewritten
+    # atomically as each result arrives.
+
+    def manifest_path(self):
+        return path.join(self.outdir, '.manifest.json')
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_path()) as f:
+                images = json.load(f)
+        except FileNotFoundError:
+            return {}
+        for d in images.values():
+            d['date'] = datetime.strptime(d['date'], MANIFEST_DATEFMT)
+        return images
+
+    def __record_result(self, future):
+        if future.exception() is not None:
+            return
+        result = dict(future.result())
+        chksum = result.pop('chksum')
+        result['date'] = result['date'].strftime(MANIFEST_DATEFMT)
+
+        # several requests may add to the same session
+        with open(path.join(self.outdir, '.manifest.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.manifest_path()) as f:
+                        images = json.load(f)
+                except FileNotFoundError:
+                    images = {}
+                images[chksum] = result
+                tmp = self.manifest_path() + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(images, f)
+                os.rename(tmp, self.manifest_path())
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
 
+    def get_remote_file(self, fd, filename):
+        chksum = store_upload(self.outdir, self.thumbdir, fd, filename)
+        print('submitting', chksum, filename, 'to image workers')
+        job = workers.submit(prepare_photo, self.outdir, self.thumbdir,
+                             chksum, filename)
+        job.add_done_callback(self.__record_result)
+        self.jobs.append(job)
+        return chksum, job
+
+    def partial_path(self, fileid):
+        return path.join(self.outdir, '.part-{0}'.format(fileid))
+
+    def finished_path(self, fileid):
+        return path.join(self.outdir, '.done-{0}'.format(fileid))
+
+    def partial_offset(self, fileid):
+        """Bytes received of `fileid`; all of them for finished files"""
+        try:
+            with open(self.finished_path(fileid)) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            pass
+        try:
+            return path.getsize(self.partial_path(fileid))
+        except OSError:
+            return 0
+
+    @contextmanager
+    def file_lock(self, fileid):
+        """Hold the lock of `fileid` or raise `UploadBusy`
+
+        A stalled request may still be appending to a file while the
+        client has resumed it with another one.
+        """
+        with open(path.join(self.outdir, '.lock-{0}'.format(fileid)), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadBusy('upload of this file in progress')
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __mark_finished(self, fileid, size):
+        with open(self.finished_path(fileid), 'w') as f:
+            f.write(str(size))
+
+    def staged_size(self):
+        """Bytes of all files staged in this session, partial or not"""
+        total = 0
         for name in os.listdir(self.outdir):
             fp = path.join(self.outdir, name)
-            if not path.isfile(fp):
-                print('  skipping file \'{0}\''.format(name))
-                continue
-            print('loading file \'{0}\' to session {1}'.format(name, self.sessionid))
-            self.images[name] = {'date': get_exifdate(fp),
-                                 'filename': name}
-
-    def get_remote_file(self, fd, filename):
-        print('submitting', fd, filename,' to pool')
-        self.pool.apply_async(prepare_photo, (self.outdir, self.thumbdir, fd, filename),
-                              callback=self.__handle_result)
+            if path.isfile(fp):
+                total += path.getsize(fp)
+        return total
+
+    def write_chunk(self, fileid, offset, stream, size):
+        """Append the data of `stream` to the partial upload `fileid` at
+        `offset`, hashing it on the way; `size` is the final file size
+
+        Returns the new offset.
+        """
+        p = self.partial_path(fileid)
+        current = self.partial_offset(fileid)
+        if offset != current:
+            raise OffsetMismatch(current)
+
+        key = (self.sessionid, fileid)
+        with _partial_lock:
+            dig, hashed = _partial_hashes.get(key, (None, None))
+        if hashed != current:
+            dig = md5()
+            if current > 0:
+                with open(p, 'rb') as f:
+                    md5hex_update(dig, f)
+
+        with open(p, 'ab') as fout:
+            buf = stream.read(buffer_size)
+            while buf:
+                current += len(buf)
+                if current > size:
+                    raise UploadError('More data than announced ({0} bytes)'.format(size))
+                dig.update(buf)
+                fout.write(buf)
+                buf = stream.read(buffer_size)
+
+        with _partial_lock:
+            _partial_hashes[key] = (dig, current)
+        return current
+
+    def finish_file(self, fileid, filename):
+        """Turn the complete partial upload `fileid` into a staged image and
+        submit it to the image workers
+
+        Finished files are remembered, so `partial_offset` reports them as
+        complete after a reload of the upload page.
+        """
+        key = (self.sessionid, fileid)
+        p = self.partial_path(fileid)
+        current = self.partial_offset(fileid)
+        with _partial_lock:
+            dig, hashed = _partial_hashes.pop(key, (None, None))
+        if hashed != current:
+            with open(p, 'rb') as f:
+                chksum = md5hex(f)
+        else:
+            chksum = dig.hexdigest()
+
+        impath = self.image_path(chksum, False)
+        if path.exists(impath):
+            os.remove(p)
+            self.__mark_finished(fileid, current)
+            raise UploadError("'{0}' was already uploaded".format(filename))
+        os.rename(p, impath)
+        self.__mark_finished(fileid, current)
+
+        print('submitting', chksum, filename, 'to image workers')
+        job = workers.submit(prepare_photo, self.outdir, self.thumbdir,
+                             chksum, filename)
+        job.add_done_callback(self.__record_result)
+        self.jobs.append(job)
+        return chksum, job
 
     def finish_uploads(self):
-        self.pool.close()
-        self.pool.join()
+        for job in self.jobs:
+            try:
+                result = job.result()
+            except Exception as e:
+                print('image processing failed:', e)
+                continue
+            self.__handle_result(result)
+        self.jobs = []
 
     def __handle_result(self, result):
         print('handle_result', result)
@@ -150,19 +572,56 @@ class UploadSession:
         else:
             return path.join(self.outdir, chksum)
 
-    def dbimport(self, table):
-        added = datetime.utcnow()
-        for chksum, d in self.images.items():
-            date = d['date']
-            comment = d['comment']
-
-            move(self.image_path(chksum, False),
-                 photo_storage.path(chksum, False))
-            move(self.image_path(chksum, True),
-                 photo_storage.path(chksum, True))
+    def dbimport(self, table, batch_size=50):
+        """Move the staged images to the photo storage and add them to
+        `table`
 
-            table.create(chksum=chksum, date=date, added=added,
-                         comment=comment, mimetype='image/jpeg')
+        Either all images are imported or, on errors, none: files already
+        moved are put back to the staging directory. Images already in
+        `table` are skipped; their checksums are returned.
+        """
+        added = datetime.utcnow()
+        rows = []
+        moved = []
+        existing = set()
+        chksums = list(self.images)
+        for i in range(0, len(chksums), batch_size):
+            q = table.select(table.chksum).where(table.chksum << chksums[i:i + batch_size])
+            existing.update(p.chksum for p in q)
+
+        try:
+            for chksum, d in self.images.items():
+                if chksum in existing:
+                    continue
+                for thumb in (False, True):
+                    # left over by a failed import; the content is the same
+                    if photo_storage.exists(chksum, thumb):
+                        continue
+                    photo_storage.store(chksum, thumb, self.image_path(chksum, thumb))
+                    moved.append((chksum, thumb))
+
+                row = {'chksum': chksum, 'date': d['date'], 'added': added,
+                       'comment': d['comment'], 'mimetype': 'image/jpeg',
+                       'width': d['width'], 'height': d['height'],
+                       'rotation': d['rotation'], 'camera': d['camera']}
+                if d.get('phash') is not None:
+                    row.update(phash_fields(d['phash']))
+                rows.append(row)
+
+            # one transaction for all rows; SQLite limits the number of
+            # variables per statement, hence the batches
+            with table._meta.database.transaction():
+                for i in range(0, len(rows), batch_size):
+                    batch = rows[i:i + batch_size]
+                    table.insert_many(batch).execute()
+                    index_comments(table.select(table.id, table.comment)
+                                        .where(table.chksum << [r['chksum'] for r in batch]))
+                adjust_photo_count(len(rows))
+        except:
+            for chksum, thumb in reversed(moved):
+                photo_storage.retrieve(chksum, thumb, self.image_path(chksum, thumb))
+            raise
+        return sorted(existing)
 
     def clear(self):
         if path.exists(self.outdir):
@@ -5,16 +5,63 @@
 from functools import wraps
 from math import ceil
 from time import time
-
-from flask import render_template, session, redirect, url_for, flash, escape, abort, send_file, request, jsonify, send_from_directory
+import os
+import re
+from threading import Lock
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from hashlib import sha1
+import hmac
+
+from flask import g, render_template, session, redirect, url_for, flash, escape, abort, request, jsonify
 from werkzeug import check_password_hash
+from werkzeug.security import safe_join
 
 from .application import app
-from .models import User, Photo
+from .models import db, User, Photo, photo_count, similar_photos, index_comments, comment_matches
 from . import forms
 from . import photo_storage
-from .upload import UploadSession, rotate_photo
+from .upload import UploadSession, rotate_photo, start_job, get_job, end_job, UploadError, OffsetMismatch, UploadBusy
+
+
+def user_fingerprint(user):
+    """Changes whenever the password or the role of `user` changes"""
+    msg = '{0}:{1}:{2}'.format(user.id, user.password, user.uploader)
+    return sha1(msg.encode('utf-8')).hexdigest()[:16]
+
+def remember_user(user):
+    session['userid'] = user.id
+    session['uploader'] = user.uploader
+    session['fingerprint'] = user_fingerprint(user)
+    session['checked'] = time()
+
+def forget_user():
+    for key in ('userid', 'uploader', 'fingerprint', 'checked'):
+        session.pop(key, None)
+
+def current_user():
+    """The logged in `User`, loaded at most once per request"""
+    if getattr(g, 'user', None) is None:
+        try:
+            g.user = User.get(User.id == session['userid'])
+        except User.DoesNotExist:
+            g.user = None
+    return g.user
+
+def session_valid():
+    """Check the user data cached in the session against the database
+    every USER_CHECK_INTERVAL seconds."""
+    if 'fingerprint' not in session:
+        return False
+    if time() - session.get('checked', 0) < app.config.get('USER_CHECK_INTERVAL', 300):
+        return True
 
+    user = current_user()
+    if user is None or user_fingerprint(user) != session['fingerprint']:
+        return False
+    session['checked'] = time()
+    return True
 
 def logged_in(f):
     @wraps(f)
@@ -22,6 +69,10 @@ def logged_in(f):
         if 'userid' not in session:
             flash('Du bist nicht angemeldet!')
             return redirect(url_for('login'))
+        if not session_valid():
+            forget_user()
+            flash('Bitte melde dich erneut an!')
+            return redirect(url_for('login'))
         return f(*args, **kwargs)
     return wrapped
 
@@ -31,24 +82,82 @@ def logged_in(f):
 def index():
     return redirect(url_for('timeline'))
 
-def safe_index(l, i, default=None):
-    try:
-        return l[i]
-    except IndexError:
-        return default
-
-def last_item(iterable, default=None):
-    for default in iterable:
-        pass
+def first_item(query, default=None):
+    for item in query.limit(1):
+        return item
     return default
 
-def is_uploader(uid=None):
-    if uid is None:
-        uid = session['userid']
+def sort_field(order):
+    if order == 'taken':
+        return Photo.date
+    return Photo.added
+
+def newer_photos(field, n, key=None, phid=None):
+    """The `n` photos following (`key`, `phid`) in ascending (`field`, id)
+    order. Without a key the oldest `n` photos are returned."""
+    q = Photo.select()
+    if key is not None:
+        q = q.where((field > key) | ((field == key) & (Photo.id > phid)))
+    return q.order_by(field.asc(), Photo.id.asc()).limit(n)
+
+def older_photos(field, n, key=None, phid=None):
+    """The `n` photos preceding (`key`, `phid`) in descending (`field`, id)
+    order. Without a key the newest `n` photos are returned."""
+    q = Photo.select()
+    if key is not None:
+        q = q.where((field < key) | ((field == key) & (Photo.id < phid)))
+    return q.order_by(field.desc(), Photo.id.desc()).limit(n)
+
+def encode_cursor(p, field):
+    key = getattr(p, field.name)
+    raw = '{0:%Y-%m-%dT%H:%M:%S.%f}|{1}'.format(key, p.id)
+    return urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Return the (key, id) pair encoded by `encode_cursor`."""
     try:
-        return User.get(User.id == uid).uploader
-    except User.DoesNotExist:
-        return False
+        raw = urlsafe_b64decode(cursor.encode('ascii')).decode('ascii')
+        key, phid = raw.split('|')
+        return datetime.strptime(key, '%Y-%m-%dT%H:%M:%S.%f'), int(phid)
+    except (ValueError, TypeError, UnicodeError):
+        abort(400)
+
+def gallery_url(p, order='taken'):
+    """URL of the gallery page starting with photo `p`"""
+    field = sort_field(order)
+    newer = first_item(newer_photos(field, 1, getattr(p, field.name), p.id))
+    if newer is None:
+        return url_for('gallery', order=order, _anchor=p.id)
+    # the page after the next newer photo
+    return url_for('gallery', order=order, after=encode_cursor(newer, field), _anchor=p.id)
+
+def gallery_page(order, cursor):
+    """One page of photos for the gallery and the cursor of the next page."""
+    page_size = int(app.config.get('GALLERY_PAGE_SIZE', 50))
+    field = sort_field(order)
+    if cursor:
+        key, phid = decode_cursor(cursor)
+    else:
+        key = phid = None
+
+    photos = [p for p in older_photos(field, page_size + 1, key, phid)]
+    if len(photos) > page_size:
+        photos = photos[:page_size]
+        next_cursor = encode_cursor(photos[-1], field)
+    else:
+        next_cursor = None
+    return photos, next_cursor
+
+def is_uploader():
+    """The role cached in the session, good enough for showing links"""
+    return session.get('uploader', False)
+
+def may_upload():
+    """Whether the user may change photos, checked against the database:
+    a demoted user or a changed password loses the right at once"""
+    user = current_user()
+    return (user is not None and user.uploader and
+            user_fingerprint(user) == session.get('fingerprint'))
 
 @app.route('/timeline')
 @app.route('/timeline/<int:phid>')
@@ -58,50 +167,34 @@ def timeline(phid=-1, order='taken'):
     if order not in ('taken', 'added'):
         abort(500)
 
+    field = sort_field(order)
+
     if phid >= 0:
         try:
-            Photo.get(Photo.id == phid)
+            this = Photo.get(Photo.id == phid)
         except Photo.DoesNotExist:
             abort(404)
+    else:
+        this = first_item(older_photos(field, 1))
 
     first = None
     last = None
-    new1 = None
-    new2 = None
-    this = None
-    old1 = None
-    old2 = None
-
-    if order == 'taken':
-        q = Photo.select().order_by(Photo.date.desc())
-    else:
-        q = Photo.select().order_by(Photo.added.desc())
-
-    if phid < 0:
-        this = safe_index(q, 0)
-        old1 = safe_index(q, 1)
-        old2 = safe_index(q, 2)
-        if old2 != None:
-            last = last_item(q)
+    new1 = new2 = None
+    old1 = old2 = None
+
+    if this is not None:
+        key = getattr(this, field.name)
+        newer = [p for p in newer_photos(field, 2, key, this.id)] + [None, None]
+        new1, new2 = newer[:2]
+        older = [p for p in older_photos(field, 2, key, this.id)] + [None, None]
+        old1, old2 = older[:2]
+
+        if new2 is not None:
+            first = first_item(older_photos(field, 1))
+        if old2 is not None:
+            last = first_item(newer_photos(field, 1))
             if last == old2:
                 last = None
-    else:
-        # save the iterator to a variable to make sure we do not loop more
-        # than we need to
-        enum = enumerate(q)
-        for i, p in enum:
-            if first is None:
-                first = p
-            new2 = new1
-            new1 = this
-            this = p
-            if p.id == phid:
-                old1 = safe_index(q, i+1)
-                old2 = safe_index(q, i+2)
-                break
-        last = last_item(enum, (None, None))[1]
-        if first == new1:
-            first = None
 
     return render_template('timeline.html',
                            new1=new1, new2=new2,
@@ -109,20 +202,35 @@ def timeline(phid=-1, order='taken'):
                            old1=old1, old2=old2,
                            first=first, last=last,
                            order=order,
-                           photoid=this.id,
+                           gallery_link=gallery_url(this, order) if this else None,
                            uploader=is_uploader())
 
 @app.route('/gallery')
 @app.route('/gallery/<order>')
 @logged_in
 def gallery(order='taken'):
-    if order == 'taken':
-        photos = Photo.select().order_by(Photo.date.desc())
-    else:
-        photos = Photo.select().order_by(Photo.added.desc())
+    if order not in ('taken', 'added'):
+        abort(404)
+
+    photos, next_cursor = gallery_page(order, request.args.get('after'))
 
-    return render_template('gallery.html', photos=photos, uploader=is_uploader(), order=order)
+    return render_template('gallery.html', photos=photos, next_cursor=next_cursor,
+                           uploader=is_uploader(), order=order)
+
+@app.route('/_gallery/<order>')
+@logged_in
+def gallery_json(order):
+    if order not in ('taken', 'added'):
+        abort(404)
 
+    photos, next_cursor = gallery_page(order, request.args.get('after'))
+    photos = [{'id': p.id,
+               'comment': p.comment,
+               'thumb': photo_url(p, 'small'),
+               'size': photo_size(p, 'small'),
+               'timeline': url_for('timeline', phid=p.id, order=order)}
+              for p in photos]
+    return jsonify(photos=photos, next=next_cursor)
 
 
 @app.route('/login', methods=('GET', 'POST'))
@@ -139,7 +247,7 @@ def login():
             return render_template('login.html', form=form)
 
         if check_password_hash(user.password, password):
-            session['userid'] = user.id
+            remember_user(user)
             return redirect(url_for('timeline'))
         else:
             flash('Unknown username or bad password YY')
@@ -149,10 +257,73 @@ def login():
 
 @app.route('/logout')
 def logout():
-    session.pop('userid', None)
+    forget_user()
     flash('You were logged out')
     return redirect(url_for('login'))
 
+SIGNATURE_RE = re.compile(r'^[0-9a-f]{40}$')
+
+def photo_signature(chksum, rotation, size):
+    """HMAC binding a stored file to the logged in user"""
+    msg = '{0}:{1}:{2}:{3}'.format(session['userid'], chksum, rotation, size)
+    return hmac.new(app.config['SECRET_KEY'].encode('utf-8'),
+                    msg.encode('utf-8'), sha1).hexdigest()
+
+@app.template_global()
+def photo_url(p, size='normal'):
+    """Signed URL of photo `p`
+
+    The URL carries checksum and rotation, which determine the image
+    completely, so serving it needs no database lookup and the response
+    can be cached for good.
+    """
+    return url_for('stored_photo', chksum=p.chksum, rotation=p.rotation, size=size,
+                   sig=photo_signature(p.chksum, p.rotation, size))
+
+@app.template_global()
+def photo_size(p, size='normal'):
+    """Displayed (width, height) of photo `p`, or None if unknown"""
+    if not p.width or not p.height:
+        return None
+    return photo_storage.display_size(p.width, p.height, size, p.rotation)
+
+def accepted_format(size):
+    """The best rendition format the client accepts explicitly
+
+    Wildcards do not count, as clients sending only ``*/*`` may well not
+    understand WebP.
+    """
+    if size == 'normal':
+        return 'jpeg'
+    accepted = set(mt for mt, q in request.accept_mimetypes if q > 0)
+    for fmt in photo_storage.formats():
+        if fmt != 'jpeg' and photo_storage.mimetype(fmt) in accepted:
+            return fmt
+    return 'jpeg'
+
+def send_photo(chksum, rotation, size, mimetype, immutable):
+    fmt = accepted_format(size)
+    if fmt != 'jpeg':
+        mimetype = photo_storage.mimetype(fmt)
+    try:
+        path = photo_storage.get_rendition(chksum, size, fmt, rotation)
+        st = os.stat(path)
+    except OSError:
+        abort(404)
+
+    rv = photo_storage.send(path, mimetype)
+    rv.set_etag('{0}-{1}-{2}-r{3}'.format(chksum, size, fmt, rotation))
+    if size != 'normal':
+        rv.vary.add('Accept')
+    rv.last_modified = datetime.utcfromtimestamp(int(st.st_mtime))
+    if immutable:
+        rv.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    else:
+        # the photo may be rotated, so revalidate
+        rv.headers['Cache-Control'] = 'private, no-cache'
+    # offloaded responses have no length, their ranges are left to the web server
+    return rv.make_conditional(request, accept_ranges=True, complete_length=rv.content_length)
+
 @app.route('/photo/<int:phid>')
 @app.route('/photo/<int:phid>/<size>')
 @logged_in
@@ -162,22 +333,111 @@ def photo(phid, size='normal'):
     except Photo.DoesNotExist:
         abort(404)
 
+    size = size.lower()
+    if size not in photo_storage.sizes():
+        size = 'normal'
+    return send_photo(photo.chksum, photo.rotation, size, photo.mimetype, False)
+
+@app.route('/p/<sig>/<chksum>/<int:rotation>/<size>')
+@logged_in
+def stored_photo(sig, chksum, rotation, size):
+    if size not in photo_storage.sizes() or rotation not in photo_storage.ROTATIONS:
+        abort(404)
+    # compare_digest only takes ASCII strings
+    if not SIGNATURE_RE.match(sig) or \
+            not hmac.compare_digest(sig, photo_signature(chksum, rotation, size)):
+        abort(403)
+
+    # all photos are stored as JPEG (cf. `UploadSession.dbimport`)
+    return send_photo(chksum, rotation, size, 'image/jpeg', True)
+
+YEAR_RE = re.compile(r'^(1[89]|2\d)\d\d$')
+WORD_RE = re.compile(r'\w+')
+
+def date_bound(value, end=False):
+    """The first moment of a date given as YYYY, YYYY-MM or YYYY-MM-DD, or
+    with `end` the first moment after it"""
+    parts = [int(x) for x in value.split('-')]
+    if not 1 <= len(parts) <= 3:
+        raise ValueError(value)
+    d = datetime(*(parts + [1] * (3 - len(parts))))
+    if not end:
+        return d
+    if len(parts) == 1:
+        return d.replace(year=d.year + 1)
+    if len(parts) == 2:
+        return d.replace(year=d.year + d.month // 12, month=d.month % 12 + 1)
+    return d + timedelta(days=1)
+
+def search_terms(text):
+    """Split the search `text` into an FTS5 query and the years it names
+
+    Every word is matched as prefix, so "Geburt" finds "Geburtstag".
+    """
+    words = []
+    years = []
+    for w in text.split():
+        if YEAR_RE.match(w):
+            years.append(w)
+        else:
+            words.extend(WORD_RE.findall(w))
+    query = ' '.join('"{0}"*'.format(w) for w in words) or None
+    return query, years
+
+def search_page(query, start, end, cursor):
+    """One page of the photos matching `query`, taken in [`start`, `end`),
+    and the cursor of the next page."""
+    page_size = int(app.config.get('GALLERY_PAGE_SIZE', 50))
+    if cursor:
+        key, phid = decode_cursor(cursor)
+    else:
+        key = phid = None
+
+    q = older_photos(Photo.date, page_size + 1, key, phid)
+    if query:
+        q = q.where(comment_matches(query))
+    if start:
+        q = q.where(Photo.date >= start)
+    if end:
+        q = q.where(Photo.date < end)
+
+    photos = [p for p in q]
+    if len(photos) > page_size:
+        photos = photos[:page_size]
+        next_cursor = encode_cursor(photos[-1], Photo.date)
+    else:
+        next_cursor = None
+    return photos, next_cursor
+
+@app.route('/search')
+@logged_in
+def search():
+    text = request.args.get('q', '').strip()
+    query, years = search_terms(text)
     try:
-        path = photo_storage.path(photo.chksum, size.lower() == 'small')
-    except Exception as e:
-        print(e)
-        raise e
-    return send_file(path, mimetype=photo.mimetype)
+        start = date_bound(request.args['from']) if request.args.get('from') else None
+        end = date_bound(request.args['to'], end=True) if request.args.get('to') else None
+    except (ValueError, TypeError):
+        abort(400)
+    # years in the search text narrow the date range unless one is given
+    if years and start is None and end is None:
+        start = date_bound(min(years))
+        end = date_bound(max(years), end=True)
+
+    if query is None and start is None and end is None:
+        photos, next_cursor = [], None
+    else:
+        photos, next_cursor = search_page(query, start, end, request.args.get('after'))
+
+    return render_template('search.html', photos=photos, next_cursor=next_cursor,
+                           q=text, date_from=request.args.get('from', ''),
+                           date_to=request.args.get('to', ''),
+                           uploader=is_uploader())
 
 @app.route('/edit/<int:phid>', methods=('GET', 'POST'))
 @logged_in
 def edit(phid):
-    try:
-        u = User.get(User.id == session['userid'])
-    except User.DoesNotExist:
-        abort(500)
-
-    if not u.uploader:
+    if not may_upload():
         abort(403)
 
     try:
@@ -189,28 +449,58 @@ def edit(phid):
     if form.validate_on_submit():
         p.date = form.recorded.data
         p.comment = form.comment.data
-        p.save()
+        with db.transaction():
+            p.save()
+            index_comments([p])
         return redirect(url_for('timeline', phid=phid))
 
-    return render_template('edit.html', photoid=p.id, form=form, p=p)
+    return render_template('edit.html', gallery_link=gallery_url(p), form=form, p=p)
 
 @app.route('/list')
 @app.route('/list/<int:page>')
 @logged_in
 def list(page=1):
     page_size = 10
-
-    photos = Photo.select().order_by(Photo.date.asc())
-    page_max = ceil(photos.count() / page_size)
+    field = Photo.date
+
+    count = photo_count()
+    page_max = max(1, int(ceil(count / page_size)))
+    page = min(max(page, 1), page_max)
+
+    if 'after' in request.args:
+        key, phid = decode_cursor(request.args['after'])
+        photos = [p for p in newer_photos(field, page_size, key, phid)]
+    elif 'before' in request.args:
+        key, phid = decode_cursor(request.args['before'])
+        photos = [p for p in older_photos(field, page_size, key, phid)][::-1]
+    elif page == 1:
+        photos = [p for p in newer_photos(field, page_size)]
+    elif page == page_max:
+        # align the last page with the page numbering
+        last_size = count - (page_max - 1) * page_size
+        photos = [p for p in older_photos(field, last_size)][::-1]
+    else:
+        # plain page links without a cursor
+        photos = Photo.select().order_by(field.asc(), Photo.id.asc()).paginate(page, page_size)
+        photos = [p for p in photos]
 
     if page < page_max - 1:
         first_page = page_max
     else:
         first_page = None
 
+    if photos:
+        prev_cursor = encode_cursor(photos[0], field)
+        next_cursor = encode_cursor(photos[-1], field)
+    else:
+        prev_cursor = next_cursor = None
+
     return render_template('list.html',
                            page=page,
-                           photos=photos.paginate(page, page_size),
+                           page_max=page_max,
+                           photos=photos,
+                           prev_cursor=prev_cursor,
+                           next_cursor=next_cursor,
                            newer=(page < page_max),
                            first_page=first_page,
                            uploader=is_uploader())
@@ -219,7 +509,7 @@ def list(page=1):
 @app.route('/upload', methods=('GET', 'POST'))
 @logged_in
 def upload():
-    if not is_uploader():
+    if not may_upload():
         abort(403)
 
     if request.method == 'GET':
@@ -229,10 +519,13 @@ def upload():
     print('POSTing to upload')
     try:
         session_id = session['upload_session']
-        us = UploadSession(session_id, 'load')
     except KeyError as e:
         print('no upload session:', e)
         abort(500)
+    job = end_job(session_id)
+    if job is not None:
+        job.wait()
+    us = UploadSession(session_id, 'load')
     print('POSTing to upload: {0}'.format(session_id))
 
     for chksum, comment in request.form.items():
@@ -241,27 +534,140 @@ def upload():
             abort(501)
         us.images[chksum]['comment'] = comment
         print('  ', us.images[chksum])
-    us.dbimport(Photo)
+    existing = us.dbimport(Photo)
     us.clear()
+    if existing:
+        flash('{0} Foto(s) waren schon vorhanden und wurden übersprungen.'.format(len(existing)))
 
     return redirect(url_for('list'))
 
 
-@app.route('/_upload_images', methods=('GET', 'POST'))
+# Chunked uploads
+#
+# The client creates (or resumes) an upload session, then sends each file
+# as raw request bodies of at most MAX_CONTENT_LENGTH bytes to
+# /_upload_file/<fileid>, with the offset of the chunk and the file size.
+# After a broken connection, GET /_upload_file/<fileid> tells where to
+# continue. The file id is chosen by the client.
+
+FILEID_RE = re.compile(r'^[A-Za-z0-9_-]{1,128}$')
+
+_active_uploads = {}
+_active_lock = Lock()
+
+@contextmanager
+def upload_slot():
+    """Limit the concurrent chunk requests per user"""
+    uid = session['userid']
+    with _active_lock:
+        if _active_uploads.get(uid, 0) >= app.config.get('UPLOAD_MAX_CONCURRENT', 4):
+            abort(429)
+        _active_uploads[uid] = _active_uploads.get(uid, 0) + 1
+    try:
+        yield
+    finally:
+        with _active_lock:
+            _active_uploads[uid] -= 1
+
+def current_upload_session(fileid):
+    if not FILEID_RE.match(fileid):
+        abort(400)
+    try:
+        return UploadSession(session['upload_session'])
+    except KeyError:
+        abort(404)
+
+@app.route('/_upload_session', methods=('POST',))
 @logged_in
-def upload_images():
+def upload_session():
+    if not may_upload():
+        abort(403)
+
+    session_id = session.get('upload_session')
+    if request.form.get('resume') and session_id and get_job(session_id) is not None:
+        return jsonify(session=session_id)
+
     session_id = '{0}::{1}'.format(session['userid'], time())
     session['upload_session'] = session_id
-    us = UploadSession(session_id, 'create')
-    for f in request.files.getlist('files[]'):
-        us.get_remote_file(f, f.filename)
-    us.finish_uploads()
-    images = [{'chksum': chksum,
-               'date': im['date'].strftime('%d.%m.%Y %H:%M:%S')}
-               for chksum, im in us.images.items()]
-    ret = {'session': session_id, 'images': images}
-    print('XX', ret)
-    return jsonify(**ret)
+    UploadSession(session_id, 'create')
+    start_job(session_id)
+    return jsonify(session=session_id)
+
+@app.route('/_upload_file/<fileid>', methods=('GET', 'POST'))
+@logged_in
+def upload_file(fileid):
+    if not may_upload():
+        abort(403)
+    us = current_upload_session(fileid)
+    if request.method == 'GET':
+        return jsonify(offset=us.partial_offset(fileid))
+
+    try:
+        filename = request.args['name']
+        size = int(request.args['size'])
+        offset = int(request.args['offset'])
+    except (KeyError, ValueError):
+        abort(400)
+    if size > app.config.get('UPLOAD_MAX_FILE_SIZE', 2**30):
+        abort(413)
+    if us.staged_size() + (request.content_length or 0) > app.config.get('UPLOAD_MAX_SESSION_SIZE', 2**33):
+        abort(413)
+
+    with upload_slot():
+        try:
+            with us.file_lock(fileid):
+                return write_file_chunk(us, fileid, filename, offset, size)
+        except UploadBusy as e:
+            return jsonify(error=str(e)), 409
+
+def write_file_chunk(us, fileid, filename, offset, size):
+    try:
+        offset = us.write_chunk(fileid, offset, request.stream, size)
+    except OffsetMismatch as e:
+        return jsonify(error=str(e), offset=e.offset), 409
+    except UploadError as e:
+        return jsonify(error=str(e)), 400
+
+    if offset < size:
+        return jsonify(offset=offset)
+
+    job = get_job(us.sessionid)
+    try:
+        chksum, future = us.finish_file(fileid, filename)
+    except UploadError as e:
+        if job is not None:
+            job.add(filename, error=str(e))
+        return jsonify(offset=offset, error=str(e))
+    if job is not None:
+        job.add(filename, chksum, future)
+    return jsonify(offset=offset, chksum=chksum)
+
+def job_status(job):
+    status = job.status()
+    for f in status['files']:
+        if 'date' in f:
+            f['date'] = f['date'].strftime('%d.%m.%Y %H:%M:%S')
+        h = f.pop('phash', None)
+        if h is None:
+            continue
+        # looked up once per file, not on every poll
+        similar = job.similar.get(f['chksum'])
+        if similar is None:
+            similar = [{'id': p.id, 'thumb': photo_url(p, 'small')}
+                       for p in similar_photos(h, app.config.get('DUPLICATE_DISTANCE', 3))]
+            job.similar[f['chksum']] = similar
+        f['similar'] = similar
+    return status
+
+@app.route('/_upload_status/<path:session_id>')
+@logged_in
+def upload_status(session_id):
+    if session_id != session.get('upload_session'):
+        abort(403)
+    job = get_job(session_id)
+    if job is None:
+        abort(404)
+    return jsonify(**job_status(job))
 
 @app.route('/preview/<chksum>')
 @logged_in
@@ -274,23 +680,25 @@ def preview(chksum):
     print('preview', session_id)
 
     us = UploadSession(session_id)
-    return send_from_directory(us.thumbdir, chksum, mimetype='image/jpeg')
+    path = safe_join(us.thumbdir, chksum)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    return photo_storage.send(path, 'image/jpeg')
 
 @app.route('/_rotate/<int:phid>/<direction>')
 @logged_in
 def rotate(phid, direction):
-    if not is_uploader():
+    if not may_upload():
         abort(403)
 
     try:
-        chksum = Photo.get(Photo.id == phid).chksum
+        p = Photo.get(Photo.id == phid)
     except Photo.DoesNotExist:
         abort(404)
+    print('+++ rotating', phid, 'to the', direction, p.chksum)
 
-    print('+++ rotating', phid, 'to the', direction, chksum)
-
-    rotate_photo(chksum, direction)
+    rotate_photo(p, direction)
 
-    url = url_for('photo', phid=phid, size='small', _anchor='')
+    url = photo_url(p, 'small')
 
-    return jsonify(status='success', url=url)
+    return jsonify(status='success', url=url, size=photo_size(p, 'small'))
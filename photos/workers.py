@@ -0,0 +1,98 @@
+##
+## Copyright (c) 2014 Jan Eike von Seggern
+##
+
+"""Process pool for CPU bound image work
+
+One pool per process, shared by all requests (or by `manage-photos.py`).
+IMAGE_WORKERS sets the number of worker processes (default: number of
+CPUs) and IMAGE_QUEUE_DEPTH the number of jobs that may be pending before
+`submit` blocks.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock
+
+from .application import app
+
+_lock = Lock()
+_executor = None
+_slots = None
+
+def _pool():
+    """The executor and the semaphore limiting its pending jobs"""
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            workers = app.config.get('IMAGE_WORKERS') or os.cpu_count() or 1
+            depth = app.config.get('IMAGE_QUEUE_DEPTH') or 4 * workers
+            _slots = BoundedSemaphore(depth)
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        return _executor, _slots
+
+def executor():
+    return _pool()[0]
+
+def _discard(broken):
+    """Forget the pool `broken`, so the next job starts a new one
+
+    A pool is broken for good once one of its processes died, e.g. killed
+    for running out of memory.
+    """
+    global _executor, _slots
+    with _lock:
+        if _executor is broken:
+            _executor = None
+            _slots = None
+    broken.shutdown(wait=False)
+
+def _submit(fn, args):
+    """Submit to the current pool, replacing it once if it is broken;
+    returns the pool used and the future"""
+    for attempt in (1, 2):
+        ex, slots = _pool()
+        slots.acquire()
+        try:
+            future = ex.submit(fn, *args)
+        except BrokenProcessPool:
+            slots.release()
+            if attempt == 2:
+                raise
+            _discard(ex)
+            continue
+        except:
+            slots.release()
+            raise
+        # the semaphore of this pool, even if it is replaced meanwhile
+        future.add_done_callback(lambda f: slots.release())
+        return ex, future
+
+def submit(fn, *args):
+    """Run `fn(*args)` in a worker process and return a future
+
+    `fn` and `args` must be picklable, i.e. module level functions and
+    plain values instead of open files. A broken pool is replaced by a
+    new one.
+    """
+    return _submit(fn, args)[1]
+
+def run(fn, *args):
+    """Run `fn(*args)` in a worker process and wait for the result
+
+    A job lost with a broken pool is tried once more on a new one.
+    """
+    ex, future = _submit(fn, args)
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        _discard(ex)
+    return submit(fn, *args).result()
+
+def shutdown():
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
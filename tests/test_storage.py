@@ -0,0 +1,174 @@
+##
+## Copyright (c) 2014 Jan Eike von Seggern
+##
+
+import os
+import io
+
+import pytest
+
+from photos.storage import LocalStorage, S3Storage, DiskCache
+
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# LocalStorage
+
+def test_local_store_and_retrieve(tmpdir):
+    st = LocalStorage(str(tmpdir.mkdir('store')))
+    src = write_file(str(tmpdir.join('src')), b'photo')
+
+    st.store('ab/cd/abcd', src)
+    assert not os.path.exists(src)
+    assert st.exists('ab/cd/abcd')
+    assert read_file(st.local_path('ab/cd/abcd')) == b'photo'
+
+    dst = str(tmpdir.join('dst'))
+    st.retrieve('ab/cd/abcd', dst)
+    assert read_file(dst) == b'photo'
+    assert not st.exists('ab/cd/abcd')
+
+def test_local_write_open_remove(tmpdir):
+    st = LocalStorage(str(tmpdir))
+    st.write('thumbs-162/ab/cd/abcd', io.BytesIO(b'thumb'))
+    with st.open('thumbs-162/ab/cd/abcd') as f:
+        assert f.read() == b'thumb'
+    st.remove('thumbs-162/ab/cd/abcd')
+    assert not st.exists('thumbs-162/ab/cd/abcd')
+    # removing a missing file is fine
+    st.remove('thumbs-162/ab/cd/abcd')
+
+def test_local_legacy_layout(tmpdir):
+    tmpdir.mkdir('thumbs-162')
+    write_file(str(tmpdir.join('abcd')), b'photo')
+    write_file(str(tmpdir.join('thumbs-162', 'abcd')), b'thumb')
+
+    st = LocalStorage(str(tmpdir), legacy_layout=True)
+    assert read_file(st.local_path('ab/cd/abcd')) == b'photo'
+    assert read_file(st.local_path('thumbs-162/ab/cd/abcd')) == b'thumb'
+    assert not LocalStorage(str(tmpdir)).exists('ab/cd/abcd')
+
+
+# DiskCache
+
+def test_cache_get_fills_once(tmpdir):
+    cache = DiskCache(str(tmpdir), 100)
+    calls = []
+    def fill(dst):
+        calls.append(dst)
+        write_file(dst, b'data')
+
+    p = cache.get('ab/cd/abcd', fill)
+    assert read_file(p) == b'data'
+    assert cache.get('ab/cd/abcd', fill) == p
+    assert len(calls) == 1
+
+def test_cache_failed_fill_leaves_nothing(tmpdir):
+    cache = DiskCache(str(tmpdir), 100)
+    def fill(dst):
+        write_file(dst, b'partial')
+        raise IOError('download failed')
+
+    with pytest.raises(IOError):
+        cache.get('ab/cd/abcd', fill)
+    assert not cache.contains('ab/cd/abcd')
+    assert os.listdir(str(tmpdir.join('ab', 'cd'))) == []
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    cache = DiskCache(str(tmpdir.mkdir('cache')), 25)
+    for i, name in enumerate(('a', 'b')):
+        cache.put(name, write_file(str(tmpdir.join(name)), b'x' * 10))
+        # distinct modification times, oldest first
+        os.utime(cache.path(name), (1000 + i, 1000 + i))
+
+    cache.put('c', write_file(str(tmpdir.join('c')), b'x' * 10))
+    assert not cache.contains('a')
+    assert cache.contains('b')
+    assert cache.contains('c')
+
+def test_cache_discard_updates_size(tmpdir):
+    cache = DiskCache(str(tmpdir.mkdir('cache')), 25)
+    cache.put('a', write_file(str(tmpdir.join('a')), b'x' * 10))
+    cache.put('b', write_file(str(tmpdir.join('b')), b'x' * 10))
+    cache.discard('a')
+    cache.discard('a')
+    assert cache._size == 10
+
+def test_cache_take_updates_size(tmpdir):
+    cache = DiskCache(str(tmpdir.mkdir('cache')), 25)
+    cache.put('a', write_file(str(tmpdir.join('a')), b'x' * 10))
+    cache.take('a', str(tmpdir.join('out')))
+
+    assert read_file(str(tmpdir.join('out'))) == b'x' * 10
+    assert not cache.contains('a')
+    assert cache._size == 0
+
+
+# S3Storage, against an in-memory stand-in for the boto3 client
+
+class FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+
+    def _get(self, bucket, key, operation):
+        from botocore.exceptions import ClientError
+        try:
+            return self.objects[bucket, key]
+        except KeyError:
+            raise ClientError({'Error': {'Code': '404'}}, operation)
+
+    def upload_fileobj(self, fin, bucket, key):
+        self.objects[bucket, key] = fin.read()
+
+    def download_fileobj(self, bucket, key, fout):
+        fout.write(self._get(bucket, key, 'GetObject'))
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self._get(Bucket, Key, 'HeadObject'))}
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self._get(Bucket, Key, 'GetObject'))}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+@pytest.fixture
+def s3(tmpdir):
+    pytest.importorskip('botocore')
+    cache = DiskCache(str(tmpdir.mkdir('cache')), 2**20)
+    return S3Storage('photos', 'p/', cache, client=FakeS3Client())
+
+def test_s3_store_keeps_local_copy(s3, tmpdir):
+    src = write_file(str(tmpdir.join('src')), b'photo')
+    s3.store('ab/cd/abcd', src)
+
+    assert s3.client.objects['photos', 'p/ab/cd/abcd'] == b'photo'
+    assert s3.cache.contains('ab/cd/abcd')
+    assert read_file(s3.local_path('ab/cd/abcd')) == b'photo'
+
+def test_s3_downloads_uncached(s3):
+    s3.write('ab/cd/abcd', io.BytesIO(b'photo'))
+    assert not s3.cache.contains('ab/cd/abcd')
+    assert s3.exists('ab/cd/abcd')
+    assert read_file(s3.local_path('ab/cd/abcd')) == b'photo'
+    assert s3.open('ab/cd/abcd').read() == b'photo'
+
+def test_s3_retrieve_and_remove(s3, tmpdir):
+    s3.store('ab/cd/abcd', write_file(str(tmpdir.join('src')), b'photo'))
+    dst = str(tmpdir.join('dst'))
+    s3.retrieve('ab/cd/abcd', dst)
+
+    assert read_file(dst) == b'photo'
+    assert not s3.exists('ab/cd/abcd')
+    assert not s3.cache.contains('ab/cd/abcd')
+    assert s3.cache._size == 0
+    # removing a missing object is fine
+    s3.remove('ab/cd/abcd')